@@ -4,9 +4,22 @@ load_dotenv()
 
 import os
 import pathlib
-from google import genai
+import asyncio
+import functools
+import collections
 import time
+import hashlib
+import mmap
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from google import genai
 from google.genai import types
+from google.genai import errors
+import httpx
+import aiofiles
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+import pypdf
 
 # --- Configuration ---
 
@@ -17,30 +30,336 @@ TOP_LEVEL_FOLDER = "extraction-component"
 TEMP_OUTPUT_FOLDER = "temp_extracted_chunks"
 # This folder will store the final, combined text files
 FINAL_OUTPUT_FOLDER = "extracted_acts_final"
+# Folders inside TOP_LEVEL_FOLDER that are never treated as acts
+EXCLUDED_FOLDERS = frozenset([FINAL_OUTPUT_FOLDER, TEMP_OUTPUT_FOLDER, '.git', 'venv'])
+# Per-act file (inside the temp folder) mapping each chunk to the content hash it was extracted from
+MANIFEST_FILENAME = "_manifest.json"
+
+# --- Local Text Fast Path ---
+USE_LOCAL_TEXT_EXTRACTION = False # Read text-native chunks with pypdf instead of Gemini (keeps headers, footers and page numbers)
+MIN_LOCAL_CHARS_PER_PAGE = 150 # Below this average the chunk is treated as scanned and sent to Gemini
 
 # --- New Robustness Settings ---
-MAX_RETRIES = 3 
-RETRY_DELAY_SECONDS = 70 # Increased delay slightly
-PROACTIVE_DELAY_SECONDS = 65 # Drastically increased the proactive delay
+MAX_RETRIES = 6 # Total attempts per chunk, including the first one
+BACKOFF_INITIAL_SECONDS = 5 # First retry wait when the server gives no retry delay
+BACKOFF_MAX_SECONDS = 120 # Cap on the exponential backoff
+
+# --- Concurrency Settings ---
+MAX_ACT_WORKERS = 4 # Acts processed in parallel, each in its own process
+MAX_CONCURRENT_REQUESTS = 3 # How many chunks may be in flight at the same time, per act
+REQUESTS_PER_MINUTE = 10 # Token-bucket size shared by all workers; match this to the API key's RPM quota
+COMBINE_PREFETCH = 8 # Temp chunk files read ahead of the writer during the final combination
 # ---------------------
 
-def extract_text_from_pdf(file):
-    client = genai.Client()
+# Seconds spent blocked on the limiter or sleeping before a retry, summed over all chunks.
+WAIT_TOTALS = {"rate_limiter": 0.0, "retry_backoff": 0.0}
+
+def get_server_retry_delay(error):
+    """
+    Returns the delay (in seconds) the API asked us to wait before retrying,
+    read from the Retry-After header or the RetryInfo error detail.
+    Returns None if the server did not suggest one.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except ValueError:
+        pass
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []):
+            if detail.get("@type", "").endswith("RetryInfo") and detail.get("retryDelay"):
+                return float(detail["retryDelay"].rstrip("s"))
+    return None
+
+def is_retryable(error):
+    """Rate limits (429), server-side (5xx) and network/timeout errors are worth retrying; anything else is not."""
+    return (isinstance(error, (errors.ServerError, httpx.TransportError))
+            or (isinstance(error, errors.ClientError) and error.code == 429))
+
+exponential_backoff = wait_exponential_jitter(initial=BACKOFF_INITIAL_SECONDS, max=BACKOFF_MAX_SECONDS)
+
+def wait_before_retry(retry_state):
+    """Waits as long as the server asked for, otherwise backs off exponentially with jitter."""
+    server_delay = get_server_retry_delay(retry_state.outcome.exception())
+    return server_delay if server_delay is not None else exponential_backoff(retry_state)
+
+def log_retry(retry_state):
+    delay = retry_state.next_action.sleep
+    WAIT_TOTALS["retry_backoff"] += delay
+    chunk_basename = os.path.basename(retry_state.args[0])
+    print(f"  >! ERROR on attempt {retry_state.attempt_number}/{MAX_RETRIES} for '{chunk_basename}': {retry_state.outcome.exception()}")
+    print(f"  >! Retrying in {delay:.0f} seconds...")
+
+# Applied to every API call; the first positional argument must be the chunk path (used for logging).
+retry_transient_errors = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_before_retry,
+    stop=stop_after_attempt(MAX_RETRIES),
+    before_sleep=log_retry,
+    reraise=True,
+)
+
+class SharedRateLimiter:
+    """
+    Token bucket held in a multiprocessing Manager, so every worker process draws from
+    one REQUESTS_PER_MINUTE budget however many acts are still running. Used like
+    aiolimiter's AsyncLimiter: `async with limiter:` waits until a request may be sent.
+    """
+
+    def __init__(self, manager, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.rate_per_second = max_rate / time_period
+        self.lock = manager.Lock()
+        self.bucket = manager.dict(level=0.0, updated=time.time())
+
+    def _try_acquire(self):
+        """Takes a token and returns 0, or returns how many seconds to wait before trying again."""
+        with self.lock:
+            now = time.time()
+            level = max(0.0, self.bucket["level"] - (now - self.bucket["updated"]) * self.rate_per_second)
+            wait = max(0.0, (level + 1 - self.max_rate) / self.rate_per_second)
+            self.bucket.update(level=level if wait else level + 1, updated=now)
+            return wait
+
+    async def __aenter__(self):
+        # The Manager calls block on IPC, so they run in a thread to keep the event loop free.
+        while (wait := await asyncio.to_thread(self._try_acquire)) > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    Builds the client once per process, so every chunk reuses its HTTP connection
+    pool instead of paying for fresh connections and TLS handshakes each time.
+    """
+    return genai.Client()
+
+@retry_transient_errors
+async def upload_pdf(file, client):
+    return await client.aio.files.upload(file=file, config=types.UploadFileConfig(mime_type="application/pdf"))
+
+@retry_transient_errors
+async def generate_text(file, client, uploaded_file, limiter):
     prompt = "You are a high-precision data extraction tool. Extract the full text from the PDF. IGNORE and OMIT all headers, footers, page numbers, and marginal notes. Output only the clean, verbatim body text."
-    filepath = pathlib.Path(file)
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        config=types.GenerateContentConfig(
-        thinking_config=types.ThinkingConfig(thinking_budget=0)
-    ),
-        contents=[
-            types.Part.from_bytes(
-                data=filepath.read_bytes(),
-                mime_type='application/pdf',
-            ),
-            prompt])
+    # The limiter only blocks once the RPM quota is used up; every retry takes a fresh token.
+    wait_start = time.monotonic()
+    async with limiter:
+        WAIT_TOTALS["rate_limiter"] += time.monotonic() - wait_start
+        response = await client.aio.models.generate_content(
+            model="gemini-2.5-flash",
+            config=types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_budget=0)
+        ),
+            contents=[uploaded_file, prompt])
     return response.text
 
+def extract_text_locally(file):
+    """
+    Returns the text of a text-native PDF, or None if the PDF looks scanned (too little
+    extractable text per page) or pypdf cannot read it, so Gemini has to do the OCR.
+    """
+    try:
+        page_texts = [page.extract_text() or "" for page in pypdf.PdfReader(file).pages]
+    except Exception as e: # pypdf raises a wide range of errors on malformed files
+        print(f"  >! Local text extraction failed for '{os.path.basename(file)}', using Gemini: {e}")
+        return None
+    text = "\n".join(page_texts)
+    if not page_texts or len(text.strip()) < MIN_LOCAL_CHARS_PER_PAGE * len(page_texts):
+        return None
+    return text
+
+async def extract_text_from_pdf(file, limiter):
+    """
+    Reads text-native PDFs locally when USE_LOCAL_TEXT_EXTRACTION is on. Otherwise
+    uploads the PDF once through the Files API (the SDK streams it from disk) and
+    reuses the uploaded handle for every generate attempt, so retries never
+    re-send the PDF. The upload is deleted from the server afterwards.
+    Returns the text and which extractor produced it ("local" or "gemini").
+    """
+    if USE_LOCAL_TEXT_EXTRACTION:
+        local_text = await asyncio.to_thread(extract_text_locally, file)
+        if local_text is not None:
+            print(f"  > '{os.path.basename(file)}' is text-native. Extracted locally.")
+            return local_text, "local"
+
+    client = get_client()
+    uploaded_file = await upload_pdf(file, client)
+    try:
+        return await generate_text(file, client, uploaded_file, limiter), "gemini"
+    finally:
+        # A failed cleanup must not throw away text that was already extracted.
+        try:
+            await client.aio.files.delete(name=uploaded_file.name)
+        except Exception as e:
+            print(f"  >! Warning: Could not delete uploaded file {uploaded_file.name}. Error: {e}")
+
+def read_text_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+async def prefetch_text_files(paths):
+    """
+    Yields a read task per path, in the given order, while up to COMBINE_PREFETCH
+    files are read ahead in worker threads. Awaiting a task returns the file's text.
+    """
+    pending = collections.deque()
+    for path in paths:
+        pending.append(asyncio.create_task(asyncio.to_thread(read_text_file, path)))
+        if len(pending) >= COMBINE_PREFETCH:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def hash_pdf(file):
+    """
+    Hashes the PDF's bytes. blake2b is used for speed; the key does not need to be
+    cryptographic. The file is memory-mapped so the hash reads straight from the page
+    cache instead of copying the whole PDF into a bytes object first.
+    """
+    with open(file, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0: # mmap cannot map an empty file
+            return hashlib.blake2b(digest_size=16).hexdigest()
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm, digest_size=16).hexdigest()
+
+def load_manifest(temp_act_chunk_path):
+    manifest_path = os.path.join(temp_act_chunk_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(temp_act_chunk_path, manifest):
+    # Write to a side file first so an interrupted run never leaves a truncated manifest behind.
+    manifest_path = os.path.join(temp_act_chunk_path, MANIFEST_FILENAME)
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+async def process_chunk(chunk_path, chunk_hash, chunk_mtime, temp_act_chunk_path, manifest, semaphore, limiter):
+    chunk_basename = os.path.basename(chunk_path)
+    chunk_txt_filename = f"{pathlib.Path(chunk_basename).stem}.{chunk_hash[:8]}.txt"
+    temp_txt_path = os.path.join(temp_act_chunk_path, chunk_txt_filename)
+
+    # Errors that survive the retries propagate to process_act_async, which reports the chunk as failed.
+    async with semaphore:
+        clean_text, extractor = await extract_text_from_pdf(chunk_path, limiter)
+
+    # Save the successful chunk to the temp folder
+    async with aiofiles.open(temp_txt_path, "w", encoding="utf-8") as f:
+        await f.write(clean_text)
+    manifest[chunk_basename] = {"hash": chunk_hash, "mtime": chunk_mtime, "output_file": chunk_txt_filename, "extractor": extractor}
+    save_manifest(temp_act_chunk_path, manifest)
+    print(f"  > SUCCESS on '{chunk_basename}'. Saved to temp folder.\n")
+
+async def process_act_async(act_name, semaphore, limiter):
+    final_output_path = os.path.join(TOP_LEVEL_FOLDER, FINAL_OUTPUT_FOLDER)
+    temp_output_path_base = os.path.join(TOP_LEVEL_FOLDER, TEMP_OUTPUT_FOLDER)
+
+    print(f"\n{'='*50}\nProcessing Act: {act_name}\n{'='*50}")
+
+    nested_act_path = os.path.join(TOP_LEVEL_FOLDER, act_name, act_name)
+    temp_act_chunk_path = os.path.join(temp_output_path_base, act_name)
+    os.makedirs(temp_act_chunk_path, exist_ok=True)
+
+    chunks_to_process = []
+    for subfolder in ["Initial Chunk", "Overlap Chunk"]:
+        try:
+            with os.scandir(os.path.join(nested_act_path, subfolder)) as entries:
+                chunks_to_process.extend(sorted(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith(".pdf")))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+    if not chunks_to_process:
+        print(f"  No PDF chunks found for {act_name}. Skipping.")
+        return
+
+    print(f"Found {len(chunks_to_process)} PDF chunks to process for '{act_name}'.")
+
+    # --- THE CHECKPOINT LOGIC ---
+    # Chunks are keyed on a hash of their bytes, so a renamed chunk reuses its earlier output.
+    with os.scandir(temp_act_chunk_path) as entries:
+        done_files = {entry.name for entry in entries if entry.is_file()}
+    manifest = load_manifest(temp_act_chunk_path)
+    # Locally extracted text is only reused while the fast path is on; entries without an extractor predate it.
+    reusable_entries = [entry for entry in manifest.values()
+                        if entry["output_file"] in done_files and (USE_LOCAL_TEXT_EXTRACTION or entry.get("extractor", "gemini") == "gemini")]
+    outputs_by_hash = {entry["hash"]: (entry["output_file"], entry.get("extractor", "gemini")) for entry in reusable_entries}
+
+    pending_chunks = []
+    for chunk_path in chunks_to_process:
+        chunk_basename = os.path.basename(chunk_path)
+        chunk_mtime = os.stat(chunk_path).st_mtime
+        entry = manifest.pop(chunk_basename, None)
+        # An unchanged mtime means the bytes are unchanged too, so the stored hash can be reused.
+        chunk_hash = entry["hash"] if entry and entry["mtime"] == chunk_mtime else hash_pdf(chunk_path)
+
+        output_file, extractor = outputs_by_hash.get(chunk_hash, (None, None))
+        legacy_txt_filename = f"{pathlib.Path(chunk_basename).stem}.txt"
+        if output_file is None and entry is None and legacy_txt_filename in done_files:
+            # Adopt checkpoints written before chunks were keyed on their hash.
+            output_file, extractor = legacy_txt_filename, "gemini"
+
+        if output_file:
+            print(f"  > Skipping '{chunk_basename}'. Already processed.")
+            manifest[chunk_basename] = {"hash": chunk_hash, "mtime": chunk_mtime, "output_file": output_file, "extractor": extractor}
+        else:
+            pending_chunks.append((chunk_path, chunk_hash, chunk_mtime))
+    save_manifest(temp_act_chunk_path, manifest)
+    # ---------------------------
+
+    tasks = [process_chunk(chunk_path, chunk_hash, chunk_mtime, temp_act_chunk_path, manifest, semaphore, limiter)
+             for chunk_path, chunk_hash, chunk_mtime in pending_chunks]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for (chunk_path, _, _), result in zip(pending_chunks, results):
+        if isinstance(result, Exception):
+            print(f"  >!!! FAILED to process chunk '{os.path.basename(chunk_path)}': {result}")
+
+    # --- Final Combination ---
+    print(f"\nCombining all successfully extracted chunks for {act_name}...")
+
+    temp_txt_paths = []
+    for chunk_path in chunks_to_process: # Iterate in original sorted order
+        entry = manifest.get(os.path.basename(chunk_path))
+        if entry:
+            temp_txt_paths.append(os.path.join(temp_act_chunk_path, entry["output_file"]))
+
+    if temp_txt_paths:
+        output_filename = f"{act_name}.txt"
+        final_act_path = os.path.join(final_output_path, output_filename)
+        # Reads overlap with writing, but are consumed in chunk order
+        async with aiofiles.open(final_act_path, "w", encoding="utf-8") as f:
+            is_first = True
+            async for read_task in prefetch_text_files(temp_txt_paths):
+                if not is_first:
+                    await f.write("\n\n")
+                await f.write(await read_task)
+                is_first = False
+        print(f"SUCCESS: Consolidated act saved to '{final_act_path}'")
+
+def init_act_worker(limiter):
+    """
+    Runs once in each worker process. The event loop and semaphore live for every act
+    the worker handles; the limiter is shared with the other workers.
+    """
+    global worker_loop, worker_semaphore, worker_limiter
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+    worker_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    worker_limiter = limiter
+
+def process_act(act_name):
+    """Processes one act inside a worker process and returns the wait time it spent, per kind."""
+    waits_before = dict(WAIT_TOTALS)
+    worker_loop.run_until_complete(process_act_async(act_name, worker_semaphore, worker_limiter))
+    return {kind: WAIT_TOTALS[kind] - waits_before[kind] for kind in WAIT_TOTALS}
+
 def main():
     final_output_path = os.path.join(TOP_LEVEL_FOLDER, FINAL_OUTPUT_FOLDER)
     temp_output_path_base = os.path.join(TOP_LEVEL_FOLDER, TEMP_OUTPUT_FOLDER)
@@ -48,80 +367,25 @@ def main():
     os.makedirs(temp_output_path_base, exist_ok=True)
 
     print(f"Starting extraction inside folder: '{TOP_LEVEL_FOLDER}'")
+
+    run_start = time.monotonic()
     
-    main_act_folders = [f for f in os.listdir(TOP_LEVEL_FOLDER) if os.path.isdir(os.path.join(TOP_LEVEL_FOLDER, f)) and f not in [FINAL_OUTPUT_FOLDER, TEMP_OUTPUT_FOLDER, '.git', 'venv']]
+    with os.scandir(TOP_LEVEL_FOLDER) as entries:
+        main_act_folders = [entry.name for entry in entries if entry.is_dir() and entry.name not in EXCLUDED_FOLDERS]
     
-    for act_name in main_act_folders:
-        print(f"\n{'='*50}\nProcessing Act: {act_name}\n{'='*50}")
-
-        nested_act_path = os.path.join(TOP_LEVEL_FOLDER, act_name, act_name)
-        temp_act_chunk_path = os.path.join(temp_output_path_base, act_name)
-        os.makedirs(temp_act_chunk_path, exist_ok=True)
-        
-        chunks_to_process = []
-        for subfolder in ["Initial Chunk", "Overlap Chunk"]:
-            subfolder_path = os.path.join(nested_act_path, subfolder)
-            if os.path.isdir(subfolder_path):
-                for filename in sorted(os.listdir(subfolder_path)):
-                    if filename.lower().endswith(".pdf"):
-                        chunks_to_process.append(os.path.join(subfolder_path, filename))
-        
-        if not chunks_to_process:
-            print(f"  No PDF chunks found for {act_name}. Skipping.")
-            continue
-            
-        print(f"Found {len(chunks_to_process)} PDF chunks to process for '{act_name}'.")
-
-        for chunk_path in chunks_to_process:
-            chunk_basename = os.path.basename(chunk_path)
-            chunk_txt_filename = f"{pathlib.Path(chunk_basename).stem}.txt"
-            temp_txt_path = os.path.join(temp_act_chunk_path, chunk_txt_filename)
-
-            # --- THE CHECKPOINT LOGIC ---
-            if os.path.exists(temp_txt_path):
-                print(f"  > Skipping '{chunk_basename}'. Already processed.")
-                continue
-            # ---------------------------
-
-            for attempt in range(MAX_RETRIES):
-                try:
-                    clean_text = extract_text_from_pdf(chunk_path)
-                    
-                    # Save the successful chunk to the temp folder
-                    with open(temp_txt_path, "w", encoding="utf-8") as f:
-                        f.write(clean_text)
-                    print(f"  > SUCCESS on '{chunk_basename}'. Saved to temp folder.\n")
-                    
-                    print(f"  ...waiting for {PROACTIVE_DELAY_SECONDS} seconds to avoid rate limit...")
-                    time.sleep(PROACTIVE_DELAY_SECONDS)
-                    break 
-
-                except Exception as e:
-                    print(f"  >! UNEXPECTED ERROR on attempt {attempt + 1}/{MAX_RETRIES}: {e}")
-                    time.sleep(10)
-            else: 
-                print(f"  >!!! FAILED to process chunk '{chunk_basename}' after {MAX_RETRIES} attempts.")
-
-        # --- Final Combination ---
-        print(f"\nCombining all successfully extracted chunks for {act_name}...")
-        
-        final_text_parts = []
-        for chunk_path in chunks_to_process: # Iterate in original sorted order
-            chunk_txt_filename = f"{pathlib.Path(os.path.basename(chunk_path)).stem}.txt"
-            temp_txt_path = os.path.join(temp_act_chunk_path, chunk_txt_filename)
-            if os.path.exists(temp_txt_path):
-                with open(temp_txt_path, "r", encoding="utf-8") as f:
-                    final_text_parts.append(f.read())
-        
-        if final_text_parts:
-            full_act_text = "\n\n".join(final_text_parts)
-            output_filename = f"{act_name}.txt"
-            final_act_path = os.path.join(final_output_path, output_filename)
-            with open(final_act_path, "w", encoding="utf-8") as f:
-                f.write(full_act_text)
-            print(f"SUCCESS: Consolidated act saved to '{final_act_path}'")
+    # Acts share no state, so each one is handed to a separate worker process.
+    run_waits = {kind: 0.0 for kind in WAIT_TOTALS}
+    with multiprocessing.Manager() as manager:
+        limiter = SharedRateLimiter(manager, REQUESTS_PER_MINUTE)
+        with ProcessPoolExecutor(max_workers=MAX_ACT_WORKERS, initializer=init_act_worker, initargs=(limiter,)) as executor:
+            for act_waits in executor.map(process_act, main_act_folders):
+                for kind, seconds in act_waits.items():
+                    run_waits[kind] += seconds
 
     print(f"\n{'='*50}\nAll legal acts have been processed.")
+    wall_time = time.monotonic() - run_start
+    print(f"Total time: {wall_time:.0f}s. Waiting on rate limiter: {run_waits['rate_limiter']:.0f}s, "
+          f"sleeping before retries: {run_waits['retry_backoff']:.0f}s (summed across concurrent chunks).")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,15 +3,19 @@ load_dotenv()
 
 import os
 import pathlib
+import asyncio
+import collections
 import google.generativeai as genai
-import time
-import json
+import orjson
+from aiolimiter import AsyncLimiter
+import aiofiles
 
 # --- Configuration ---
 API_KEY = os.environ.get("GOOGLE_API_KEY")
 if not API_KEY:
     raise ValueError("GOOGLE_API_KEY not found. Please set it in your .env file.")
 genai.configure(api_key=API_KEY)
+MODEL = genai.GenerativeModel(model_name="models/gemini-1.5-flash-latest")
 
 # Using "." means the script looks for act folders in its current directory
 TOP_LEVEL_FOLDER = "." 
@@ -19,30 +23,85 @@ TOP_LEVEL_FOLDER = "."
 # --- Output Folder Setup ---
 FINAL_OUTPUT_FOLDER = "extracted_acts_structured_json"
 TEMP_CHUNK_JSON_FOLDER = "temp_chunk_json"
+EXCLUDED_FOLDERS = frozenset([FINAL_OUTPUT_FOLDER, TEMP_CHUNK_JSON_FOLDER, '.git', 'venv'])
 
 # --- Robustness Settings ---
 MAX_RETRIES = 3 
 RETRY_DELAY_SECONDS = 70 # Increased delay to be safe
-PROACTIVE_DELAY_SECONDS = 5
+
+# --- Concurrency Settings ---
+MAX_CONCURRENT_REQUESTS = 3 # How many chunks may be in flight at the same time
+UPLOAD_AHEAD = 2 # Chunks uploaded and waiting for a free extractor
+INLINE_PDF_MAX_BYTES = 18_000_000 # Smaller chunks are sent inline with the request (API limit is 20MB)
+REQUESTS_PER_SECOND = 5 # Ceiling on how fast new requests are sent to the API
+COMBINE_PREFETCH = 8 # Temp JSON files read ahead of the writer during the final combination
 # ---------------------
 
-def extract_structure_from_chunk(pdf_chunk_path):
+def read_inline_pdf(pdf_chunk_path):
+    """Reads a small PDF chunk into an inline part, which needs no upload or delete round-trip."""
+    return {"mime_type": "application/pdf", "data": pathlib.Path(pdf_chunk_path).read_bytes()}
+
+def upload_chunk(pdf_chunk_path):
+    """Uploads a single PDF chunk through the file upload API and returns its handle."""
+    print(f"    - Uploading {os.path.basename(pdf_chunk_path)}...")
+    return genai.upload_file(path=pdf_chunk_path, mime_type="application/pdf")
+
+def delete_upload(uploaded_file):
+    """Deletes an uploaded chunk from the server to clean up storage."""
+    print(f"    - Deleting uploaded file {uploaded_file.name} from server...")
+    genai.delete_file(uploaded_file.name)
+
+def extract_structure_from_pdf_part(pdf_part):
     """
-    Uploads a single PDF chunk and uses a powerful prompt to get its structure as JSON.
-    This version uses the file upload API for maximum reliability.
+    Uses a powerful prompt on a PDF chunk (an inline part or an uploaded file handle) to
+    get its structure as JSON. Uploading and deleting the file are separate pipeline
+    stages (see process_act_chunks).
     """
-    print(f"  > Processing chunk: {os.path.basename(pdf_chunk_path)}...")
-    uploaded_file = None
-    try:
-        # Step 1: Upload the file to the server.
-        print(f"    - Uploading...")
-        uploaded_file = genai.upload_file(path=pdf_chunk_path, mime_type="application/pdf")
+    # JSON mode with a schema makes the model return bare, valid JSON
+    response_schema = {
+        "type": "OBJECT",
+        "properties": {
+            "act_name": {
+                "type": "STRING",
+                "description": "The name of the act, or 'Unknown' if it is not in this fragment."
+            },
+            "act_number": {
+                "type": "STRING",
+                "description": "The number of the act, or 'Unknown' if it is not in this fragment."
+            },
+            "clauses": {
+                "type": "ARRAY",
+                "description": "Every piece of text in this fragment, one object per citation.",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "citation_path": {
+                            "type": "ARRAY",
+                            "description": "The citation hierarchy visible in this fragment, e.g. ['Section 8', 'Subsection (a)', 'Clause (iv)'].",
+                            "items": {"type": "STRING"}
+                        },
+                        "full_citation_string": {
+                            "type": "STRING",
+                            "description": "The complete citation as a single string."
+                        },
+                        "content": {
+                            "type": "STRING",
+                            "description": "The verbatim text for this specific citation."
+                        }
+                    },
+                    "required": ["citation_path", "full_citation_string", "content"]
+                }
+            }
+        },
+        "required": ["act_name", "act_number", "clauses"]
+    }
 
-        # Step 2: Make the API call using the uploaded file handle.
-        print(f"    - Extracting structure...")
-        model = genai.GenerativeModel(model_name="models/gemini-1.5-flash-latest")
-        
-        prompt = """
+    generation_config = genai.GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=response_schema
+    )
+
+    prompt = """
         You are an expert legal document parser. The user has provided you with a PDF that is a SMALL FRAGMENT of a larger Sri Lankan legal act. Your task is to analyze ONLY this fragment and convert it into a structured JSON format.
 
         Follow these rules precisely:
@@ -55,19 +114,124 @@ def extract_structure_from_chunk(pdf_chunk_path):
         7.  The "content" must be the verbatim text for that specific citation.
         8.  Ignore all page headers, footers, page numbers, and marginal notes.
         """
-        
-        response = model.generate_content([prompt, uploaded_file], request_options={"timeout": 300})
-        
-        clean_json_string = response.text.strip().lstrip("```json").rstrip("```")
-        return json.loads(clean_json_string)
+    
+    response = MODEL.generate_content(
+        [prompt, pdf_part],
+        generation_config=generation_config,
+        request_options={"timeout": 300}
+    )
+    
+    return orjson.loads(response.text)
+
+async def write_json_element(out, element, is_first, indent):
+    """
+    Appends one element to a JSON array that is being streamed into `out`,
+    pretty-printed the same way json.dump(..., indent=2) would lay it out.
+    `out` must be an aiofiles handle opened in binary mode; orjson always emits UTF-8.
+    """
+    indent = indent.encode()
+    separator = b"\n" if is_first else b",\n"
+    await out.write(separator + indent + orjson.dumps(element, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n" + indent))
+
+def read_temp_json(path):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+async def prefetch_temp_json(paths):
+    """
+    Yields (path, load_task) pairs in the given order while up to COMBINE_PREFETCH
+    files are read and parsed ahead in worker threads. Awaiting a task returns the
+    parsed JSON or raises its read/decode error.
+    """
+    pending = collections.deque()
+    for path in paths:
+        pending.append((path, asyncio.create_task(asyncio.to_thread(read_temp_json, path))))
+        if len(pending) >= COMBINE_PREFETCH:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+async def call_with_retries(func, arg, chunk_basename, limiter):
+    """
+    Runs one blocking API call in a worker thread, retrying it up to MAX_RETRIES times.
+    Returns None once every attempt has failed.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with limiter:
+                return await asyncio.to_thread(func, arg)
+        except Exception as e:
+            print(f"  >! ERROR on attempt {attempt + 1}/{MAX_RETRIES} for '{chunk_basename}': {e}")
+            if "429" in str(e) or "ResourceExhausted" in str(e):
+                print(f"  >! Rate limit hit. Waiting for {RETRY_DELAY_SECONDS} seconds...")
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+            else:
+                await asyncio.sleep(10)
+    print(f"  >!!! FAILED to process chunk '{chunk_basename}' after {MAX_RETRIES} attempts.")
+    return None
 
+async def process_act_chunks(chunks, temp_act_chunk_path, done_files, limiter):
+    """
+    Runs an act's chunks through a three-stage pipeline so upload time overlaps
+    extraction time: one uploader keeps up to UPLOAD_AHEAD chunks uploaded ahead of
+    MAX_CONCURRENT_REQUESTS extractors, and a deleter removes finished uploads
+    from the server in the background. Chunks under INLINE_PDF_MAX_BYTES are read
+    locally and sent inline instead, skipping the upload and delete stages.
+    """
+    upload_queue = asyncio.Queue(maxsize=UPLOAD_AHEAD)
+    delete_queue = asyncio.Queue()
+
+    async def uploader():
+        for chunk in chunks:
+            chunk_path, chunk_basename, _ = chunk
+            try:
+                if os.path.getsize(chunk_path) < INLINE_PDF_MAX_BYTES:
+                    pdf_part = await asyncio.to_thread(read_inline_pdf, chunk_path)
+                else:
+                    pdf_part = await call_with_retries(upload_chunk, chunk_path, chunk_basename, limiter)
+            except OSError as e:
+                print(f"  >!!! FAILED to read chunk '{chunk_basename}': {e}")
+                continue
+            if pdf_part is not None:
+                await upload_queue.put((chunk, pdf_part))
+        for _ in range(MAX_CONCURRENT_REQUESTS):
+            await upload_queue.put(None)
+
+    async def extractor():
+        while (item := await upload_queue.get()) is not None:
+            (chunk_path, chunk_basename, chunk_json_filename), pdf_part = item
+            try:
+                print(f"  > Extracting structure from chunk: {chunk_basename}...")
+                # Retries reuse the same upload rather than sending the PDF again.
+                structured_data = await call_with_retries(extract_structure_from_pdf_part, pdf_part, chunk_basename, limiter)
+                if structured_data is None:
+                    continue
+                async with aiofiles.open(f"{temp_act_chunk_path}/{chunk_json_filename}", "wb") as f:
+                    await f.write(orjson.dumps(structured_data, option=orjson.OPT_INDENT_2))
+                done_files.add(chunk_json_filename)
+                print(f"  > SUCCESS on '{chunk_basename}'. Temp JSON saved.\n")
+            except OSError as e:
+                print(f"  >!!! FAILED to save chunk '{chunk_basename}': {e}")
+            finally:
+                # ALWAYS delete an uploaded file from the server, whether or not extraction worked.
+                if not isinstance(pdf_part, dict):
+                    delete_queue.put_nowait(pdf_part)
+
+    async def deleter():
+        while (uploaded_file := await delete_queue.get()) is not None:
+            try:
+                await asyncio.to_thread(delete_upload, uploaded_file)
+            except Exception as e:
+                print(f"  >! Warning: Could not delete uploaded file {uploaded_file.name}. Error: {e}")
+
+    deleter_task = asyncio.create_task(deleter())
+    try:
+        await asyncio.gather(uploader(), *(extractor() for _ in range(MAX_CONCURRENT_REQUESTS)))
     finally:
-        # Step 3: ALWAYS delete the file from the server to clean up storage.
-        if uploaded_file:
-            print(f"    - Deleting uploaded file from server...")
-            genai.delete_file(uploaded_file.name)
+        delete_queue.put_nowait(None)
+        await deleter_task
 
-def main():
+async def main():
     final_output_path = os.path.join(TOP_LEVEL_FOLDER, FINAL_OUTPUT_FOLDER)
     temp_output_path_base = os.path.join(TOP_LEVEL_FOLDER, TEMP_CHUNK_JSON_FOLDER)
     os.makedirs(final_output_path, exist_ok=True)
@@ -75,21 +239,38 @@ def main():
 
     print(f"Starting CHUNK-BY-CHUNK structured JSON extraction from: '{os.path.abspath(TOP_LEVEL_FOLDER)}'")
     
-    main_act_folders = [f for f in os.listdir(TOP_LEVEL_FOLDER) if os.path.isdir(os.path.join(TOP_LEVEL_FOLDER, f)) and f not in [FINAL_OUTPUT_FOLDER, TEMP_CHUNK_JSON_FOLDER, '.git', 'venv']]
+    with os.scandir(TOP_LEVEL_FOLDER) as entries:
+        main_act_folders = [entry.name for entry in entries if entry.is_dir() and entry.name not in EXCLUDED_FOLDERS]
     
+    with os.scandir(final_output_path) as entries:
+        finished_act_files = {entry.name for entry in entries if entry.is_file()}
+
+    limiter = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+
     for act_name in main_act_folders:
         print(f"\n{'='*60}\nProcessing Act: {act_name}\n{'='*60}")
         
         final_act_json_path = os.path.join(final_output_path, f"{act_name}.json")
-        if os.path.exists(final_act_json_path):
+        if f"{act_name}.json" in finished_act_files:
             print(f"  > Final file already exists. Skipping entire act.")
             continue
 
         nested_act_path = os.path.join(TOP_LEVEL_FOLDER, act_name, act_name)
         temp_act_chunk_path = os.path.join(temp_output_path_base, act_name)
         os.makedirs(temp_act_chunk_path, exist_ok=True)
+        with os.scandir(temp_act_chunk_path) as entries:
+            done_files = {entry.name for entry in entries if entry.is_file()}
         
-        chunks_to_process = sorted([os.path.join(nested_act_path, sub, f) for sub in ["Initial Chunk", "Overlap Chunk"] if os.path.isdir(os.path.join(nested_act_path, sub)) for f in os.listdir(os.path.join(nested_act_path, sub)) if f.lower().endswith('.pdf')])
+        # Only the two chunk subfolders are listed; os.walk would also list the act folder itself
+        chunks_to_process = []
+        for sub in ["Initial Chunk", "Overlap Chunk"]:
+            try:
+                with os.scandir(f"{nested_act_path}/{sub}") as entries:
+                    chunks_to_process.extend((entry.path, entry.name, f"{entry.name.rsplit('.', 1)[0]}.json")
+                                             for entry in entries if entry.is_file() and entry.name.lower().endswith('.pdf'))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        chunks_to_process.sort()
         
         if not chunks_to_process:
             print(f"  No PDF chunks found for {act_name}. Skipping.")
@@ -97,60 +278,51 @@ def main():
 
         print(f"Found {len(chunks_to_process)} chunks to process for '{act_name}'.")
 
-        for chunk_path in chunks_to_process:
-            chunk_basename = os.path.basename(chunk_path)
-            chunk_json_filename = f"{pathlib.Path(chunk_basename).stem}.json"
-            temp_json_path = os.path.join(temp_act_chunk_path, chunk_json_filename)
-
-            if os.path.exists(temp_json_path):
+        pending_chunks = []
+        for chunk in chunks_to_process:
+            _, chunk_basename, chunk_json_filename = chunk
+            if chunk_json_filename in done_files:
                 print(f"  > Skipping '{chunk_basename}'. Already processed.")
-                continue
+            else:
+                pending_chunks.append(chunk)
 
-            for attempt in range(MAX_RETRIES):
-                try:
-                    structured_data = extract_structure_from_chunk(chunk_path)
-                    with open(temp_json_path, "w", encoding="utf-8") as f:
-                        json.dump(structured_data, f, indent=2)
-                    print(f"  > SUCCESS on '{chunk_basename}'. Temp JSON saved.\n")
-                    time.sleep(PROACTIVE_DELAY_SECONDS)
-                    break 
-                except Exception as e:
-                    print(f"  >! ERROR on attempt {attempt + 1}/{MAX_RETRIES} for '{chunk_basename}': {e}")
-                    if "429" in str(e) or "ResourceExhausted" in str(e):
-                        print(f"  >! Rate limit hit. Waiting for {RETRY_DELAY_SECONDS} seconds...")
-                        time.sleep(RETRY_DELAY_SECONDS)
-                    else:
-                        time.sleep(10)
-            else: 
-                print(f"  >!!! FAILED to process chunk '{chunk_basename}' after {MAX_RETRIES} attempts.")
+        await process_act_chunks(pending_chunks, temp_act_chunk_path, done_files, limiter)
 
         # --- Final Combination from Temp JSONs ---
         print(f"\nCombining all temporary JSON files for {act_name}...")
-        all_clauses = []
         final_act_name, final_act_number = "Unknown", "Unknown"
         
-        temp_json_files = sorted([os.path.join(temp_act_chunk_path, f) for f in os.listdir(temp_act_chunk_path) if f.endswith('.json')])
+        temp_json_files = sorted([f"{temp_act_chunk_path}/{f}" for f in done_files if f.endswith('.json')])
 
-        for temp_json_path in temp_json_files:
-            try:
-                with open(temp_json_path, "r", encoding="utf-8") as f:
-                    temp_data = json.load(f)
-                if temp_data.get("clauses"):
-                    all_clauses.extend(temp_data["clauses"])
+        # Streamed to a ".part" file; act name/number go last since they are only known at the end
+        partial_json_path = f"{final_act_json_path}.part"
+        clause_count = 0
+        async with aiofiles.open(partial_json_path, "wb") as out:
+            await out.write(b'{\n  "clauses": [')
+            # Reads overlap with writing, but are consumed in chunk order
+            async for temp_json_path, load_task in prefetch_temp_json(temp_json_files):
+                try:
+                    temp_data = await load_task
+                except (orjson.JSONDecodeError, FileNotFoundError) as e:
+                    print(f"  >! Warning: Could not read or decode {os.path.basename(temp_json_path)}. Error: {e}")
+                    continue
+                for clause in temp_data.get("clauses") or []:
+                    await write_json_element(out, clause, clause_count == 0, "    ")
+                    clause_count += 1
                 if final_act_name == "Unknown" and temp_data.get("act_name") != "Unknown":
                     final_act_name = temp_data.get("act_name")
                 if final_act_number == "Unknown" and temp_data.get("act_number") != "Unknown":
                     final_act_number = temp_data.get("act_number")
-            except (json.JSONDecodeError, FileNotFoundError) as e:
-                print(f"  >! Warning: Could not read or decode {os.path.basename(temp_json_path)}. Error: {e}")
+            await out.write(b"\n  ]" if clause_count else b"]")
+            await out.write(b',\n  "act_name": ' + orjson.dumps(final_act_name) + b',\n  "act_number": ' + orjson.dumps(final_act_number) + b'\n}')
         
-        if all_clauses:
-            final_json_data = {"act_name": final_act_name, "act_number": final_act_number, "clauses": all_clauses}
-            with open(final_act_json_path, "w", encoding="utf-8") as f:
-                json.dump(final_json_data, f, ensure_ascii=False, indent=2)
+        if clause_count:
+            os.replace(partial_json_path, final_act_json_path)
             print(f"SUCCESS: Master structured JSON saved to '{final_act_json_path}'")
+        else:
+            os.remove(partial_json_path)
 
     print(f"\n{'='*60}\nAll legal acts have been processed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
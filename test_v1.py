@@ -3,15 +3,19 @@ load_dotenv()
 
 import os
 import pathlib
+import asyncio
+import hashlib
 import google.generativeai as genai
-import time
-import json
+import orjson
+from aiolimiter import AsyncLimiter
+import aiofiles
 
 # --- Configuration ---
 API_KEY = os.environ.get("GOOGLE_API_KEY")
 if not API_KEY:
     raise ValueError("GOOGLE_API_KEY not found. Please set it in your .env file.")
 genai.configure(api_key=API_KEY)
+MODEL = genai.GenerativeModel(model_name="models/gemini-2.5-flash")
 
 # Using "." means the script looks for act folders in its current directory
 TOP_LEVEL_FOLDER = "." 
@@ -19,22 +23,27 @@ TOP_LEVEL_FOLDER = "."
 # --- Output Folder Setup ---
 FINAL_OUTPUT_FOLDER = "extracted_acts_grouped_json" # New folder for this final format
 TEMP_CHUNK_JSON_FOLDER = "temp_chunk_grouped_json"
+EXCLUDED_FOLDERS = frozenset([FINAL_OUTPUT_FOLDER, TEMP_CHUNK_JSON_FOLDER, '.git', 'venv'])
 
 # --- Robustness Settings ---
 MAX_RETRIES = 3 
 RETRY_DELAY_SECONDS = 70 
-PROACTIVE_DELAY_SECONDS = 5
+
+# --- Concurrency Settings ---
+MAX_CONCURRENT_REQUESTS = 3 # How many chunks may be in flight at the same time
+REQUESTS_PER_SECOND = 5 # Ceiling on how fast new requests are sent to the API
+INLINE_PDF_MAX_BYTES = 18_000_000 # Smaller chunks are sent inline with the request (API limit is 20MB)
 # ---------------------
 
 def extract_structure_from_chunk(pdf_chunk_path):
     """
-    Uploads a PDF chunk and uses a JSON schema to force the model to return
+    Sends a PDF chunk and uses a JSON schema to force the model to return
     a list of objects, where each object represents a grouped, top-level section.
+    Chunks under INLINE_PDF_MAX_BYTES go inline with the request; larger ones are
+    uploaded first and deleted afterwards.
     """
     print(f"  > Processing chunk with GROUPED JSON Schema: {os.path.basename(pdf_chunk_path)}...")
     
-    model = genai.GenerativeModel(model_name="models/gemini-2.5-flash")
-    
     uploaded_file = None
     try:
         # --- THIS IS THE NEW, GROUPING SCHEMA ---
@@ -75,27 +84,81 @@ def extract_structure_from_chunk(pdf_chunk_path):
             response_schema=response_schema
         )
 
-        print(f"    - Uploading...")
-        uploaded_file = genai.upload_file(path=pdf_chunk_path, mime_type="application/pdf")
+        if os.path.getsize(pdf_chunk_path) < INLINE_PDF_MAX_BYTES:
+            # Inline data is a single round-trip: no upload before, no delete after.
+            pdf_part = {"mime_type": "application/pdf", "data": pathlib.Path(pdf_chunk_path).read_bytes()}
+        else:
+            print(f"    - Uploading...")
+            uploaded_file = genai.upload_file(path=pdf_chunk_path, mime_type="application/pdf")
+            pdf_part = uploaded_file
 
         print(f"    - Extracting structure...")
         # --- THE NEW, GROUPING PROMPT ---
         prompt = "Analyze the provided legal document fragment. For EACH top-level section number (e.g., Section 2, Section 3), create a single JSON object. The 'content' for that object must contain the combined text of that section and ALL of its subsections ((1), (2), (a), (b), etc.). Return a JSON array of these grouped objects, conforming strictly to the provided schema."
         
-        response = model.generate_content(
-            [prompt, uploaded_file],
+        response = MODEL.generate_content(
+            [prompt, pdf_part],
             generation_config=generation_config,
             request_options={"timeout": 300}
         )
         
-        return json.loads(response.text)
+        return orjson.loads(response.text)
 
     finally:
         if uploaded_file:
             print(f"    - Deleting uploaded file...")
             genai.delete_file(uploaded_file.name)
 
-def main():
+async def write_json_element(out, element, is_first, indent):
+    """
+    Appends one element to a JSON array that is being streamed into `out`,
+    pretty-printed the same way json.dump(..., indent=2) would lay it out.
+    `out` must be an aiofiles handle opened in binary mode; orjson always emits UTF-8.
+    """
+    indent = indent.encode()
+    separator = b"\n" if is_first else b",\n"
+    await out.write(separator + indent + orjson.dumps(element, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n" + indent))
+
+def clause_key(clause):
+    """
+    Identifies a clause by its section number and whitespace-normalised text, so the
+    copy re-extracted from an overlap chunk matches the one from the initial chunk.
+    """
+    normalized_content = " ".join(str(clause.get("content", "")).split())
+    key_source = f"{clause.get('clause_number', '')}\0{normalized_content}"
+    return hashlib.blake2b(key_source.encode("utf-8"), digest_size=8).digest()
+
+async def process_chunk(chunk_path, temp_act_chunk_path, done_files, semaphore, limiter):
+    chunk_basename = os.path.basename(chunk_path)
+    chunk_json_filename = f"{pathlib.Path(chunk_basename).stem}.json"
+    temp_json_path = os.path.join(temp_act_chunk_path, chunk_json_filename)
+
+    if chunk_json_filename in done_files:
+        print(f"  > Skipping '{chunk_basename}'. Already processed.")
+        return
+
+    # The semaphore caps how many chunks are in flight; the limiter paces how fast they start.
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with limiter:
+                    list_of_clauses = await asyncio.to_thread(extract_structure_from_chunk, chunk_path)
+                async with aiofiles.open(temp_json_path, "wb") as f:
+                    await f.write(orjson.dumps(list_of_clauses, option=orjson.OPT_INDENT_2))
+                done_files.add(chunk_json_filename)
+                print(f"  > SUCCESS on '{chunk_basename}'. Temp JSON saved.\n")
+                break
+            except Exception as e:
+                print(f"  >! ERROR on attempt {attempt + 1}/{MAX_RETRIES} for '{chunk_basename}': {e}")
+                if "429" in str(e) or "ResourceExhausted" in str(e):
+                    print(f"  >! Rate limit hit. Waiting for {RETRY_DELAY_SECONDS} seconds...")
+                    await asyncio.sleep(RETRY_DELAY_SECONDS)
+                else:
+                    await asyncio.sleep(10)
+        else:
+            print(f"  >!!! FAILED to process chunk '{chunk_basename}' after {MAX_RETRIES} attempts.")
+
+async def main():
     final_output_path = os.path.join(TOP_LEVEL_FOLDER, FINAL_OUTPUT_FOLDER)
     temp_output_path_base = os.path.join(TOP_LEVEL_FOLDER, TEMP_CHUNK_JSON_FOLDER)
     os.makedirs(final_output_path, exist_ok=True)
@@ -103,21 +166,37 @@ def main():
 
     print(f"Starting GROUPED JSON extraction from: '{os.path.abspath(TOP_LEVEL_FOLDER)}'")
     
-    main_act_folders = [f for f in os.listdir(TOP_LEVEL_FOLDER) if os.path.isdir(os.path.join(TOP_LEVEL_FOLDER, f)) and f not in [FINAL_OUTPUT_FOLDER, TEMP_CHUNK_JSON_FOLDER, '.git', 'venv']]
+    with os.scandir(TOP_LEVEL_FOLDER) as entries:
+        main_act_folders = [entry.name for entry in entries if entry.is_dir() and entry.name not in EXCLUDED_FOLDERS]
     
+    with os.scandir(final_output_path) as entries:
+        finished_act_files = {entry.name for entry in entries if entry.is_file()}
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+
     for act_name in main_act_folders:
         print(f"\n{'='*60}\nProcessing Act: {act_name}\n{'='*60}")
         
         final_act_json_path = os.path.join(final_output_path, f"{act_name}.json")
-        if os.path.exists(final_act_json_path):
+        if f"{act_name}.json" in finished_act_files:
             print(f"  > Final file already exists. Skipping entire act.")
             continue
 
         nested_act_path = os.path.join(TOP_LEVEL_FOLDER, act_name, act_name)
         temp_act_chunk_path = os.path.join(temp_output_path_base, act_name)
         os.makedirs(temp_act_chunk_path, exist_ok=True)
+        with os.scandir(temp_act_chunk_path) as entries:
+            done_files = {entry.name for entry in entries if entry.is_file()}
         
-        chunks_to_process = sorted([os.path.join(nested_act_path, sub, f) for sub in ["Initial Chunk", "Overlap Chunk"] if os.path.isdir(os.path.join(nested_act_path, sub)) for f in os.listdir(os.path.join(nested_act_path, sub)) if f.lower().endswith('.pdf')])
+        chunks_to_process = []
+        for sub in ["Initial Chunk", "Overlap Chunk"]:
+            try:
+                with os.scandir(os.path.join(nested_act_path, sub)) as entries:
+                    chunks_to_process.extend(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith('.pdf'))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        chunks_to_process.sort()
         
         if not chunks_to_process:
             print(f"  No PDF chunks found for {act_name}. Skipping.")
@@ -125,54 +204,49 @@ def main():
 
         print(f"Found {len(chunks_to_process)} chunks to process for '{act_name}'.")
 
-        for chunk_path in chunks_to_process:
-            chunk_basename = os.path.basename(chunk_path)
-            chunk_json_filename = f"{pathlib.Path(chunk_basename).stem}.json"
-            temp_json_path = os.path.join(temp_act_chunk_path, chunk_json_filename)
-
-            if os.path.exists(temp_json_path):
-                print(f"  > Skipping '{chunk_basename}'. Already processed.")
-                continue
-
-            for attempt in range(MAX_RETRIES):
-                try:
-                    list_of_clauses = extract_structure_from_chunk(chunk_path)
-                    with open(temp_json_path, "w", encoding="utf-8") as f:
-                        json.dump(list_of_clauses, f, indent=2)
-                    print(f"  > SUCCESS on '{chunk_basename}'. Temp JSON saved.\n")
-                    time.sleep(PROACTIVE_DELAY_SECONDS)
-                    break 
-                except Exception as e:
-                    print(f"  >! ERROR on attempt {attempt + 1}/{MAX_RETRIES} for '{chunk_basename}': {e}")
-                    if "429" in str(e) or "ResourceExhausted" in str(e):
-                        print(f"  >! Rate limit hit. Waiting for {RETRY_DELAY_SECONDS} seconds...")
-                        time.sleep(RETRY_DELAY_SECONDS)
-                    else:
-                        time.sleep(10)
-            else: 
-                print(f"  >!!! FAILED to process chunk '{chunk_basename}' after {MAX_RETRIES} attempts.")
+        tasks = [process_chunk(chunk_path, temp_act_chunk_path, done_files, semaphore, limiter) for chunk_path in chunks_to_process]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for chunk_path, result in zip(chunks_to_process, results):
+            if isinstance(result, Exception):
+                print(f"  >!!! FAILED to process chunk '{os.path.basename(chunk_path)}': {result}")
 
         # --- Final Combination Logic ---
         print(f"\nCombining all temporary JSON lists for {act_name}...")
         
-        master_clause_list = []
-        
-        temp_json_files = sorted([os.path.join(temp_act_chunk_path, f) for f in os.listdir(temp_act_chunk_path) if f.endswith('.json')])
-
-        for temp_json_path in temp_json_files:
-            try:
-                with open(temp_json_path, "r", encoding="utf-8") as f:
-                    clauses_from_chunk = json.load(f)
-                    master_clause_list.extend(clauses_from_chunk)
-            except (json.JSONDecodeError, FileNotFoundError) as e:
-                print(f"  >! Warning: Could not read or decode {os.path.basename(temp_json_path)}. Error: {e}")
+        temp_json_files = sorted([os.path.join(temp_act_chunk_path, f) for f in done_files if f.endswith('.json')])
+
+        # Streamed to a ".part" file that replaces the final path only once complete
+        partial_json_path = f"{final_act_json_path}.part"
+        clause_count = 0
+        # Overlap chunks repeat text from their neighbours by design; only the first copy is kept.
+        seen_clause_keys = set()
+        duplicate_count = 0
+        async with aiofiles.open(partial_json_path, "wb") as out:
+            await out.write(b"[")
+            for temp_json_path in temp_json_files:
+                try:
+                    with open(temp_json_path, "rb") as f:
+                        clauses_from_chunk = orjson.loads(f.read())
+                except (orjson.JSONDecodeError, FileNotFoundError) as e:
+                    print(f"  >! Warning: Could not read or decode {os.path.basename(temp_json_path)}. Error: {e}")
+                    continue
+                for clause in clauses_from_chunk:
+                    key = clause_key(clause)
+                    if key in seen_clause_keys:
+                        duplicate_count += 1
+                        continue
+                    seen_clause_keys.add(key)
+                    await write_json_element(out, clause, clause_count == 0, "  ")
+                    clause_count += 1
+            await out.write(b"\n]" if clause_count else b"]")
         
-        if master_clause_list:
-            with open(final_act_json_path, "w", encoding="utf-8") as f:
-                json.dump(master_clause_list, f, ensure_ascii=False, indent=2)
-            print(f"SUCCESS: Master list of clauses saved to '{final_act_json_path}'")
+        if clause_count:
+            os.replace(partial_json_path, final_act_json_path)
+            print(f"SUCCESS: Master list of clauses saved to '{final_act_json_path}' ({duplicate_count} duplicate clauses from overlap chunks dropped)")
+        else:
+            os.remove(partial_json_path)
 
     print(f"\n{'='*60}\nAll legal acts have been processed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file